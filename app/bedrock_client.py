@@ -2,10 +2,14 @@
 # RIVA ChatGPT - AWS Bedrock streaming client for Claude Sonnet
 
 import os
-import json
+import asyncio
 import logging
-from typing import List, Dict, Generator, Optional
+import threading
+from functools import lru_cache
+from typing import List, Dict, Generator, AsyncGenerator, Optional
 import boto3
+import orjson
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError, BotoCoreError
 
 # Configure logging
@@ -16,6 +20,25 @@ MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
 ANTHROPIC_VERSION = "bedrock-2023-05-31"
 DEFAULT_REGION = "us-east-1"
 
+# Connection pool and retry settings shared by all requests on the cached client
+BEDROCK_CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={'mode': 'adaptive'}
+)
+
+# Maximum number of chunks buffered between the Bedrock reader thread and the event loop
+STREAM_QUEUE_SIZE = 32
+
+# Sentinel put on the stream queue when the sync stream is exhausted
+_STREAM_END = object()
+
+# Roles accepted by the Anthropic messages API
+_VALID_ROLES = frozenset(('user', 'assistant', 'system'))
+
+# Markers used to pull text out of delta events without a full JSON parse
+_TEXT_FIELD = b'"text":"'
+_BACKSLASH = ord('\\')
+
 class BedrockClientError(Exception):
     """Custom exception for Bedrock client errors"""
     pass
@@ -24,10 +47,14 @@ class BedrockStreamingError(Exception):
     """Custom exception for Bedrock streaming errors"""
     pass
 
+@lru_cache(maxsize=1)
 def _get_bedrock_client():
     """
     Create and return a Bedrock runtime client with proper configuration.
     
+    The client is created once and cached so its HTTPS connection pool is
+    reused across chat requests. Failed attempts are not cached.
+    
     Returns:
         boto3.Client: Configured Bedrock runtime client
         
@@ -52,7 +79,8 @@ def _get_bedrock_client():
         # Create Bedrock runtime client
         client = session.client(
             'bedrock-runtime',
-            region_name=region
+            region_name=region,
+            config=BEDROCK_CLIENT_CONFIG
         )
         
         logger.info("Bedrock client initialized successfully")
@@ -81,45 +109,38 @@ def _format_messages_for_anthropic(messages: List[Dict[str, str]]) -> List[Dict[
     Returns:
         List[Dict]: Formatted messages for Anthropic API
     """
-    formatted_messages = []
+    if not messages:
+        return []
     
-    for message in messages:
-        # Ensure required fields
-        if 'role' not in message or 'content' not in message:
-            logger.warning(f"Skipping malformed message: {message}")
-            continue
-            
-        # Validate role
-        if message['role'] not in ['user', 'assistant', 'system']:
-            logger.warning(f"Invalid role '{message['role']}', defaulting to 'user'")
-            role = 'user'
-        else:
-            role = message['role']
-            
-        formatted_messages.append({
-            'role': role,
-            'content': str(message['content'])
-        })
+    # Single pass: drop messages missing fields, default unknown roles to 'user'
+    formatted_messages = [
+        {
+            'role': message['role'] if isinstance(message['role'], str) and message['role'] in _VALID_ROLES else 'user',
+            'content': message['content'] if type(message['content']) is str else str(message['content'])
+        }
+        for message in messages
+        if 'role' in message and 'content' in message
+    ]
     
-    logger.debug(f"Formatted {len(formatted_messages)} messages for Anthropic")
+    skipped = len(messages) - len(formatted_messages)
+    if skipped:
+        logger.warning("Skipped %d malformed messages", skipped)
+    
+    logger.debug("Formatted %d messages for Anthropic", len(formatted_messages))
     return formatted_messages
 
-def _create_bedrock_payload(messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> str:
+def _create_bedrock_payload(messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> bytes:
     """
     Create the request payload for Bedrock Anthropic model.
     
     Args:
         messages: List of formatted messages
-        temperature: Sampling temperature (0.0-1.0)
-        max_tokens: Maximum tokens to generate
+        temperature: Sampling temperature (0.0-1.0), already range-checked by ChatRequest
+        max_tokens: Maximum tokens to generate, already range-checked by ChatRequest
         
     Returns:
-        str: JSON payload for Bedrock request
+        bytes: JSON payload for Bedrock request
     """
-    # Clamp temperature to valid range
-    temperature = max(0.0, min(1.0, temperature))
-    max_tokens = max(1, min(max_tokens, 4096))  # Reasonable upper limit
-    
     payload = {
         "anthropic_version": ANTHROPIC_VERSION,
         "max_tokens": max_tokens,
@@ -127,10 +148,48 @@ def _create_bedrock_payload(messages: List[Dict[str, str]], temperature: float,
         "messages": messages
     }
     
-    logger.debug(f"Created Bedrock payload: temperature={temperature}, max_tokens={max_tokens}, messages_count={len(messages)}")
-    return json.dumps(payload)
+    logger.debug("Created Bedrock payload: temperature=%s, max_tokens=%s, messages_count=%d",
+                 temperature, max_tokens, len(messages))
+    return orjson.dumps(payload)
+
+def _extract_text_delta(raw: bytes) -> Optional[str]:
+    """
+    Extract the text of a content_block_delta/text_delta event without
+    parsing the whole JSON document.
+    
+    Only the "text" string literal is located and decoded, so JSON escapes
+    are still handled by orjson.
+    
+    Args:
+        raw: Raw chunk bytes from the Bedrock response stream
+        
+    Returns:
+        Optional[str]: The delta text, or None if the event does not have the
+        expected shape and needs a full parse
+    """
+    start = raw.find(_TEXT_FIELD)
+    if start == -1:
+        return None
+    
+    # Keep the opening quote so the slice is a complete JSON string literal
+    start += len(_TEXT_FIELD) - 1
+    end = start
+    while True:
+        end = raw.find(b'"', end + 1)
+        if end == -1:
+            return None
+        
+        # A quote preceded by an odd number of backslashes is escaped
+        backslashes = 0
+        while raw[end - 1 - backslashes] == _BACKSLASH:
+            backslashes += 1
+        if not backslashes & 1:
+            break
+    
+    return orjson.loads(raw[start:end + 1])
 
-def stream_chat(messages: List[Dict[str, str]], temperature: float = 0.2, max_tokens: int = 500) -> Generator[str, None, None]:
+def stream_chat(messages: List[Dict[str, str]], temperature: float = 0.2, max_tokens: int = 500,
+                assume_valid: bool = False, client=None) -> Generator[str, None, None]:
     """
     Generator function to stream chat responses from AWS Bedrock Claude Sonnet.
     
@@ -138,6 +197,9 @@ def stream_chat(messages: List[Dict[str, str]], temperature: float = 0.2, max_to
         messages: List of message objects with 'role' and 'content' keys
         temperature: Sampling temperature (0.0-1.0), default 0.2
         max_tokens: Maximum tokens to generate, default 500
+        assume_valid: Skip message normalization for input already validated
+            by ChatRequest, default False
+        client: Pre-built Bedrock runtime client, defaults to the cached client
         
     Yields:
         str: Text chunks from the Claude model response
@@ -154,10 +216,11 @@ def stream_chat(messages: List[Dict[str, str]], temperature: float = 0.2, max_to
     
     try:
         # Get Bedrock client
-        client = _get_bedrock_client()
+        if client is None:
+            client = _get_bedrock_client()
         
-        # Format messages for Anthropic
-        formatted_messages = _format_messages_for_anthropic(messages)
+        # Format messages for Anthropic unless they were already validated
+        formatted_messages = messages if assume_valid else _format_messages_for_anthropic(messages)
         if not formatted_messages:
             logger.error("No valid messages after formatting")
             raise BedrockStreamingError("No valid messages provided")
@@ -181,39 +244,54 @@ def stream_chat(messages: List[Dict[str, str]], temperature: float = 0.2, max_to
         
         total_tokens = 0
         
-        for event in stream:
-            chunk = event.get('chunk')
-            if chunk:
-                try:
-                    # Parse the chunk data
-                    chunk_data = json.loads(chunk.get('bytes').decode())
-                    
-                    # Handle different event types
-                    if chunk_data.get('type') == 'content_block_delta':
-                        # Extract text from content block delta
-                        delta = chunk_data.get('delta', {})
-                        if delta.get('type') == 'text_delta':
-                            text = delta.get('text', '')
-                            if text:
-                                total_tokens += len(text.split())  # Rough token count
-                                logger.debug(f"Yielding text chunk: {text[:50]}...")
-                                yield text
-                    
-                    elif chunk_data.get('type') == 'message_stop':
-                        logger.info(f"Stream completed. Approximate tokens: {total_tokens}")
-                        break
+        # Closing the generator must also release the Bedrock connection,
+        # or the model keeps generating into an unread response
+        try:
+            for event in stream:
+                chunk = event.get('chunk')
+                if chunk:
+                    try:
+                        raw = chunk['bytes']
                         
-                    elif chunk_data.get('type') == 'error':
-                        error_msg = chunk_data.get('message', 'Unknown streaming error')
-                        logger.error(f"Bedrock streaming error: {error_msg}")
-                        raise BedrockStreamingError(f"Bedrock error: {error_msg}")
+                        # Fast path: text deltas are by far the most common event
+                        text = None
+                        if b'content_block_delta' in raw and b'text_delta' in raw:
+                            text = _extract_text_delta(raw)
                         
-                except json.JSONDecodeError as e:
-                    logger.warning(f"Failed to parse chunk: {e}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error processing chunk: {e}")
-                    continue
+                        if text is None:
+                            # Parse the chunk data directly from bytes
+                            chunk_data = orjson.loads(raw)
+                            
+                            # Handle different event types
+                            if chunk_data.get('type') == 'content_block_delta':
+                                # Extract text from content block delta
+                                delta = chunk_data.get('delta', {})
+                                if delta.get('type') == 'text_delta':
+                                    text = delta.get('text', '')
+                            
+                            elif chunk_data.get('type') == 'message_stop':
+                                logger.info(f"Stream completed. Approximate tokens: {total_tokens}")
+                                break
+                                
+                            elif chunk_data.get('type') == 'error':
+                                error_msg = chunk_data.get('message', 'Unknown streaming error')
+                                logger.error(f"Bedrock streaming error: {error_msg}")
+                                raise BedrockStreamingError(f"Bedrock error: {error_msg}")
+                        
+                        if text:
+                            total_tokens += (len(text) + 3) >> 2  # Rough token count, ~4 chars per token
+                            if logger.isEnabledFor(logging.DEBUG):
+                                logger.debug("Yielding text chunk: %s...", text[:50])
+                            yield text
+                            
+                    except orjson.JSONDecodeError as e:
+                        logger.warning(f"Failed to parse chunk: {e}")
+                        continue
+                    except Exception as e:
+                        logger.error(f"Error processing chunk: {e}")
+                        continue
+        finally:
+            stream.close()
     
     except BedrockClientError:
         # Re-raise client errors as-is
@@ -240,6 +318,88 @@ def stream_chat(messages: List[Dict[str, str]], temperature: float = 0.2, max_to
         logger.error(f"Unexpected error in stream_chat: {e}")
         raise BedrockStreamingError(f"Unexpected streaming error: {e}")
 
+def _drain_stream(chunks: Generator[str, None, None], queue: asyncio.Queue,
+                  loop: asyncio.AbstractEventLoop, cancelled: threading.Event) -> None:
+    """
+    Iterate a stream_chat generator in a reader thread, handing each chunk to
+    the event loop through a bounded queue.
+    
+    The last item put on the queue is _STREAM_END, or the exception raised by
+    the stream. Nothing more is put once the consumer has cancelled.
+    
+    Args:
+        chunks: Sync generator returned by stream_chat
+        queue: Bounded queue read by astream_chat on the event loop
+        loop: Event loop that owns the queue
+        cancelled: Set by the consumer when it stops reading
+    """
+    final_item = _STREAM_END
+    try:
+        for text in chunks:
+            # Blocks while the queue is full, so a slow client throttles the read
+            asyncio.run_coroutine_threadsafe(queue.put(text), loop).result()
+            if cancelled.is_set():
+                break
+    except Exception as e:
+        final_item = e
+    finally:
+        chunks.close()
+    
+    if not cancelled.is_set():
+        asyncio.run_coroutine_threadsafe(queue.put(final_item), loop).result()
+
+async def astream_chat(messages: List[Dict[str, str]], temperature: float = 0.2, max_tokens: int = 500,
+                       assume_valid: bool = False, client=None) -> AsyncGenerator[str, None]:
+    """
+    Async generator wrapping stream_chat for use inside the FastAPI event loop.
+    
+    The blocking boto3 response stream is read in a dedicated thread and bridged
+    through a bounded asyncio.Queue, so the event loop never waits on the socket.
+    A thread per stream is used instead of the default executor, which would cap
+    the number of concurrent chats at its pool size.
+    
+    Args:
+        messages: List of message objects with 'role' and 'content' keys
+        temperature: Sampling temperature (0.0-1.0), default 0.2
+        max_tokens: Maximum tokens to generate, default 500
+        assume_valid: Skip message normalization for pre-validated input, default False
+        client: Pre-built Bedrock runtime client, defaults to the cached client
+        
+    Yields:
+        str: Text chunks from the Claude model response
+        
+    Raises:
+        BedrockClientError: If client setup fails
+        BedrockStreamingError: If streaming fails
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    cancelled = threading.Event()
+    chunks = stream_chat(messages, temperature=temperature, max_tokens=max_tokens,
+                         assume_valid=assume_valid, client=client)
+    
+    reader = threading.Thread(
+        target=_drain_stream,
+        args=(chunks, queue, loop, cancelled),
+        name="bedrock-stream-reader",
+        daemon=True
+    )
+    reader.start()
+    
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop the reader thread and unblock any put waiting on a full queue
+        cancelled.set()
+        while not queue.empty():
+            queue.get_nowait()
+
 def test_bedrock_connection() -> bool:
     """
     Test the Bedrock connection and model access.
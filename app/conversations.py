@@ -0,0 +1,90 @@
+# Server-side conversation history
+# RIVA ChatGPT - keeps chat history on the backend so clients only send new messages
+
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from .schemas import MAX_CHAT_MESSAGES
+
+# Upper bound on conversations kept in memory per server process
+MAX_CONVERSATIONS = 256
+
+def trim_history(messages: List[Dict[str, str]], max_messages: int) -> List[Dict[str, str]]:
+    """
+    Keep only the most recent messages of a conversation.
+
+    Leading non-user messages left over after trimming are dropped as well,
+    so the history still starts with a user turn as Anthropic requires.
+
+    Args:
+        messages: Message dicts with 'role' and 'content' keys, oldest first
+        max_messages: Maximum number of messages to keep
+
+    Returns:
+        List[Dict]: The trimmed messages (the input list if already short enough)
+    """
+    if len(messages) <= max_messages:
+        return messages
+    start = len(messages) - max_messages
+    while start < len(messages) and messages[start]['role'] != 'user':
+        start += 1
+    return messages[start:]
+
+class ConversationStore:
+    """
+    Bounded in-memory store of conversation histories.
+
+    Least recently used conversations are evicted once the store is full.
+    Each conversation keeps at most max_messages messages, oldest dropped first.
+    History is kept per server process, so a client routed to another worker
+    (or talking to a restarted server) gets "not found" and must resend the
+    full history. Only accessed from the event loop, so no locking is needed.
+    """
+
+    def __init__(self, max_conversations: int = MAX_CONVERSATIONS, max_messages: int = MAX_CHAT_MESSAGES):
+        self.max_conversations = max_conversations
+        self.max_messages = max_messages
+        self._conversations: "OrderedDict[str, List[Dict[str, str]]]" = OrderedDict()
+
+    def create(self) -> str:
+        """
+        Start a new, empty conversation.
+
+        Returns:
+            str: The new conversation ID
+        """
+        conversation_id = uuid.uuid4().hex
+        self._conversations[conversation_id] = []
+        if len(self._conversations) > self.max_conversations:
+            self._conversations.popitem(last=False)
+        return conversation_id
+
+    def get(self, conversation_id: str) -> Optional[List[Dict[str, str]]]:
+        """
+        Look up the stored history of a conversation.
+
+        Args:
+            conversation_id: ID returned by create()
+
+        Returns:
+            Optional[List[Dict]]: Copy of the stored messages, or None if unknown
+        """
+        history = self._conversations.get(conversation_id)
+        if history is None:
+            return None
+        self._conversations.move_to_end(conversation_id)
+        return list(history)
+
+    def append(self, conversation_id: str, messages: List[Dict[str, str]]) -> None:
+        """
+        Append messages to a conversation, ignoring conversations already evicted.
+
+        Args:
+            conversation_id: ID returned by create()
+            messages: Message dicts with 'role' and 'content' keys
+        """
+        history = self._conversations.get(conversation_id)
+        if history is not None:
+            history.extend(messages)
+            self._conversations[conversation_id] = trim_history(history, self.max_messages)
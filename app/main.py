@@ -1,54 +1,83 @@
 # FastAPI main application
 # RIVA ChatGPT Backend API
 
+import os
+import sys
 import logging
-import json
 import asyncio
-from datetime import datetime
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from typing import AsyncGenerator
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import ValidationError
+import orjson
 import uvicorn
 
 # Import our schemas and bedrock client
 from .schemas import (
-    ChatRequest, ChatResponse, HealthResponse, ErrorResponse,
+    ChatRequest, ChatResponse, HealthResponse, ErrorResponse, MAX_CHAT_MESSAGES,
     SSETokenEvent, SSEDoneEvent, SSEErrorEvent, SSEHeartbeatEvent,
     Message, MessageRole
 )
-from .bedrock_client import stream_chat, BedrockClientError, BedrockStreamingError, MODEL_ID
+from .bedrock_client import (
+    astream_chat, _get_bedrock_client, BedrockClientError, BedrockStreamingError, MODEL_ID
+)
+from .conversations import ConversationStore, trim_history
 
-# Configure logging
+# Configure logging; thread and process info are never shown in the log format
+logging.logThreads = False
+logging.logProcesses = False
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 logger = logging.getLogger(__name__)
 
+# Application lifespan: build the Bedrock client once before serving requests
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("RIVA ChatGPT API server starting up...")
+    try:
+        app.state.bedrock = _get_bedrock_client()
+    except BedrockClientError as e:
+        # Keep serving; the client is created lazily on the first chat request
+        logger.warning(f"Bedrock client prewarm failed: {e}")
+        app.state.bedrock = None
+    app.state.conversations = ConversationStore()
+    logger.info("Server is ready to accept requests")
+    try:
+        yield
+    finally:
+        logger.info("RIVA ChatGPT API server shutting down...")
+
 # Create FastAPI application
 app = FastAPI(
     title="RIVA ChatGPT API",
     description="A minimal ChatGPT-like demo with streaming responses using AWS Bedrock",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan
 )
 
 # Configure CORS middleware for local development
 app.add_middleware(
     CORSMiddleware,
+    # Exact origins only: Starlette does not glob-match ports in allow_origins
     allow_origins=[
-        "http://localhost:*",
-        "http://127.0.0.1:*", 
         "http://localhost:8501",  # Streamlit default port
+        "http://127.0.0.1:8501",
         "http://localhost:3000",  # Common dev port
+        "http://127.0.0.1:3000",
         "http://localhost:8080",  # Common dev port
+        "http://127.0.0.1:8080",
     ],
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    allow_headers=["*"],
+    allow_headers=["content-type", "authorization", "accept"],
 )
 
 # Global exception handler
@@ -94,18 +123,63 @@ async def root():
         "health": "/health"
     }
 
-# Helper function to format SSE events
-def format_sse_event(event_data: dict) -> str:
+# Pre-encoded SSE frames and frame prefixes for the fixed-shape events
+_DONE_FRAME = b'data: {"type":"done"}\n\n'
+_PING_FRAME = b': ping\n\n'  # SSE comment, ignored by clients
+_CONVERSATION_PREFIX = b'data: {"type":"conversation","conversation_id":"'
+_TOKEN_PREFIX = b'data: {"type":"token","text":'
+_HEARTBEAT_PREFIX = b'data: {"type":"heartbeat","timestamp":"'
+_ERROR_PREFIX = b'data: {"type":"error","message":'
+
+def format_sse_token(text: str) -> bytes:
+    """
+    Format a token SSE event without building an SSETokenEvent.
+    
+    Args:
+        text: Text chunk from the AI response
+        
+    Returns:
+        bytes: SSE frame matching SSETokenEvent
+    """
+    # join builds the frame in one allocation instead of chaining temporaries
+    return b"".join((_TOKEN_PREFIX, orjson.dumps(text), b'}\n\n'))
+
+def format_sse_conversation(conversation_id: str) -> bytes:
+    """
+    Format a conversation SSE event without building an SSEConversationEvent.
+    
+    Args:
+        conversation_id: Server-side conversation ID (hex, no escaping needed)
+        
+    Returns:
+        bytes: SSE frame matching SSEConversationEvent
+    """
+    return _CONVERSATION_PREFIX + conversation_id.encode() + b'"}\n\n'
+
+def format_sse_heartbeat(timestamp: str) -> bytes:
     """
-    Format data as Server-Sent Event.
+    Format a heartbeat SSE event without building an SSEHeartbeatEvent.
     
     Args:
-        event_data: Dictionary to send as SSE event
+        timestamp: ISO formatted timestamp of the heartbeat
         
     Returns:
-        str: Properly formatted SSE event string
+        bytes: SSE frame matching SSEHeartbeatEvent
     """
-    return f"data: {json.dumps(event_data)}\n\n"
+    return _HEARTBEAT_PREFIX + timestamp.encode() + b'"}\n\n'
+
+def format_sse_error(message: str, code: str) -> bytes:
+    """
+    Format an error SSE event without building an SSEErrorEvent.
+    
+    Args:
+        message: Error message shown to the client
+        code: Error code
+        
+    Returns:
+        bytes: SSE frame matching SSEErrorEvent
+    """
+    return _ERROR_PREFIX + orjson.dumps(message) + b',"code":' + orjson.dumps(code) + b'}\n\n'
 
 # Streaming chat endpoint
 @app.post("/chat",
@@ -117,99 +191,131 @@ async def chat_stream(request: ChatRequest, http_request: Request):
     Streaming chat endpoint that accepts conversation messages and returns
     real-time AI responses via Server-Sent Events.
     
+    The conversation history is kept server-side: the stream announces a
+    conversation ID, and requests carrying that ID only send new messages.
+    
     Args:
         request: Chat request with messages and parameters
         http_request: HTTP request object for connection monitoring
         
     Returns:
         StreamingResponse: SSE stream with AI responses
+        
+    Raises:
+        HTTPException: 409 if the conversation ID is unknown to this server;
+            the client should resend the full history without an ID
     """
     logger.info(f"Chat request received: {len(request.messages)} messages, temp={request.temperature}, max_tokens={request.max_tokens}")
     
-    async def generate_chat_stream() -> AsyncGenerator[str, None]:
+    conversations: ConversationStore = http_request.app.state.conversations
+    if request.conversation_id is None:
+        conversation_id = conversations.create()
+        history = []
+    else:
+        conversation_id = request.conversation_id
+        history = conversations.get(conversation_id)
+        if history is None:
+            raise HTTPException(status_code=409, detail="Unknown conversation, resend the full history")
+    
+    async def generate_chat_stream() -> AsyncGenerator[bytes, None]:
         """Generate the SSE stream for chat responses"""
         
         heartbeat_interval = 30  # Send heartbeat every 30 seconds
-        last_heartbeat = datetime.now()
+        disconnect_check_mask = 15  # Poll for client disconnect every 16 tokens
+        last_heartbeat = time.monotonic()
+        
+        # Flush response headers before any Bedrock work so the client sees
+        # the stream open immediately
+        yield _PING_FRAME
+        yield format_sse_conversation(conversation_id)
+        
+        new_messages = []
+        reply_chunks = []
+        
+        def store_exchange():
+            """Append the new messages and the streamed reply to the stored history"""
+            if reply_chunks:
+                conversations.append(
+                    conversation_id,
+                    new_messages + [{"role": "assistant", "content": "".join(reply_chunks)}]
+                )
         
         try:
-            # Convert Pydantic models to dict format for bedrock client
-            messages_dict = [
-                {"role": msg.role, "content": msg.content} 
-                for msg in request.messages
-            ]
+            # Convert validated Pydantic models to dict format for bedrock client,
+            # sending no more history than a single request may carry
+            new_messages = request.model_dump(include={"messages"})["messages"]
+            messages_dict = trim_history(history + new_messages, MAX_CHAT_MESSAGES)
             
             logger.info(f"Starting Bedrock stream with model: {MODEL_ID}")
             
             # Start streaming from Bedrock
             token_count = 0
-            for text_chunk in stream_chat(
+            async for text_chunk in astream_chat(
                 messages=messages_dict,
                 temperature=request.temperature,
-                max_tokens=request.max_tokens
+                max_tokens=request.max_tokens,
+                assume_valid=True,
+                client=getattr(http_request.app.state, "bedrock", None)
             ):
                 # Check if client disconnected
-                if await http_request.is_disconnected():
+                if (token_count & disconnect_check_mask) == 0 and await http_request.is_disconnected():
                     logger.info("Client disconnected, stopping stream")
                     break
                 
                 # Send text token event
                 if text_chunk:
-                    token_event = SSETokenEvent(text=text_chunk)
-                    yield format_sse_event(token_event.dict())
+                    yield format_sse_token(text_chunk)
+                    reply_chunks.append(text_chunk)
                     token_count += 1
                     
                     # Send periodic heartbeat
-                    current_time = datetime.now()
-                    if (current_time - last_heartbeat).seconds >= heartbeat_interval:
-                        heartbeat_event = SSEHeartbeatEvent(timestamp=current_time.isoformat())
-                        yield format_sse_event(heartbeat_event.dict())
+                    # Wall-clock time is only formatted when a heartbeat is due
+                    current_time = time.monotonic()
+                    if current_time - last_heartbeat >= heartbeat_interval:
+                        yield format_sse_heartbeat(datetime.now(timezone.utc).isoformat())
                         last_heartbeat = current_time
-                
-                # Small delay to prevent overwhelming the connection
-                await asyncio.sleep(0.01)
+            
+            # Store the exchange, including a reply stopped by the disconnect check
+            store_exchange()
             
             # Send completion event
-            done_event = SSEDoneEvent()
-            yield format_sse_event(done_event.dict())
+            yield _DONE_FRAME
             
             logger.info(f"Chat stream completed successfully. Tokens sent: {token_count}")
             
         except BedrockClientError as e:
             logger.error(f"Bedrock client error: {e}")
-            error_event = SSEErrorEvent(
+            yield format_sse_error(
                 message="Failed to connect to AI service. Please check your AWS configuration.",
                 code="BEDROCK_CLIENT_ERROR"
             )
-            yield format_sse_event(error_event.dict())
             
         except BedrockStreamingError as e:
             logger.error(f"Bedrock streaming error: {e}")
-            error_event = SSEErrorEvent(
+            yield format_sse_error(
                 message=f"AI service error: {str(e)}",
                 code="BEDROCK_STREAMING_ERROR"
             )
-            yield format_sse_event(error_event.dict())
             
         except ValidationError as e:
             logger.error(f"Request validation error: {e}")
-            error_event = SSEErrorEvent(
+            yield format_sse_error(
                 message="Invalid request format. Please check your message format.",
                 code="VALIDATION_ERROR"
             )
-            yield format_sse_event(error_event.dict())
             
         except asyncio.CancelledError:
             logger.info("Stream cancelled by client")
-            # Don't send error event for cancellation
+            # Keep the partial reply the client has already shown, and don't
+            # send an error event for cancellation
+            store_exchange()
             
         except Exception as e:
             logger.error(f"Unexpected error in chat stream: {e}")
-            error_event = SSEErrorEvent(
+            yield format_sse_error(
                 message="An unexpected error occurred. Please try again.",
                 code="INTERNAL_ERROR"
             )
-            yield format_sse_event(error_event.dict())
     
     # Return streaming response
     return StreamingResponse(
@@ -218,28 +324,31 @@ async def chat_stream(request: ChatRequest, http_request: Request):
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "*",
         }
     )
 
-# Application startup event
-@app.on_event("startup")
-async def startup_event():
-    logger.info("RIVA ChatGPT API server starting up...")
-    logger.info("Server is ready to accept requests")
-
-# Application shutdown event  
-@app.on_event("shutdown")
-async def shutdown_event():
-    logger.info("RIVA ChatGPT API server shutting down...")
-
 if __name__ == "__main__":
     # Run the server directly if this file is executed
-    uvicorn.run(
-        "app.main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+    if os.getenv("API_RELOAD", "false").lower() == "true":
+        # Development: auto-reload runs a single worker on the default loop
+        uvicorn.run(
+            "app.main:app",
+            host="0.0.0.0",
+            port=8000,
+            reload=True,
+            log_level="info"
+        )
+    else:
+        # Production: uvloop (not available on Windows) and httptools for
+        # lower per-write overhead on the SSE stream. Conversation history is
+        # held in process memory, so extra workers (API_WORKERS) make clients
+        # resend their full history whenever a turn reaches another worker.
+        uvicorn.run(
+            "app.main:app",
+            host="0.0.0.0",
+            port=8000,
+            loop="asyncio" if sys.platform == "win32" else "uvloop",
+            http="httptools",
+            workers=int(os.getenv("API_WORKERS", "1")),
+            log_level="info"
+        )
\ No newline at end of file
@@ -1,10 +1,13 @@
 # Pydantic schemas for request/response validation
 # RIVA ChatGPT - API request and response models
 
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, field_validator, ConfigDict
 from typing import List, Optional, Literal, Union
 from enum import Enum
 
+# Maximum number of messages sent to the model in one request
+MAX_CHAT_MESSAGES = 50
+
 class MessageRole(str, Enum):
     """Valid message roles for chat conversations"""
     SYSTEM = "system"
@@ -16,11 +19,11 @@ class Message(BaseModel):
     role: MessageRole = Field(..., description="The role of the message sender")
     content: str = Field(..., min_length=1, max_length=32000, description="The message content")
     
-    class Config:
-        # Allow enum values to be serialized as strings
-        use_enum_values = True
+    # Allow enum values to be serialized as strings
+    model_config = ConfigDict(use_enum_values=True)
         
-    @validator('content')
+    @field_validator('content')
+    @classmethod
     def content_must_not_be_empty(cls, v):
         if not v or not v.strip():
             raise ValueError('Message content cannot be empty or whitespace only')
@@ -28,12 +31,17 @@ class Message(BaseModel):
 
 class ChatRequest(BaseModel):
     """Chat API request schema with comprehensive validation"""
-    messages: List[Message] = Field(..., min_items=1, max_items=50, description="List of conversation messages")
+    messages: List[Message] = Field(..., min_length=1, max_length=MAX_CHAT_MESSAGES, description="List of conversation messages")
     temperature: Optional[float] = Field(default=0.2, ge=0.0, le=1.0, description="Sampling temperature (0.0-1.0)")
     max_tokens: Optional[int] = Field(default=500, ge=1, le=4096, description="Maximum tokens to generate")
     stream: Optional[bool] = Field(default=True, description="Enable streaming response")
+    conversation_id: Optional[str] = Field(
+        default=None, max_length=64,
+        description="Server-side conversation to continue; messages then holds only the new messages"
+    )
     
-    @validator('messages')
+    @field_validator('messages')
+    @classmethod
     def validate_messages(cls, v):
         if not v:
             raise ValueError('At least one message is required')
@@ -51,6 +59,7 @@ class SSEEventType(str, Enum):
     DONE = "done"
     ERROR = "error"
     HEARTBEAT = "heartbeat"
+    CONVERSATION = "conversation"
 
 class SSETokenEvent(BaseModel):
     """SSE event for streaming text tokens"""
@@ -72,8 +81,13 @@ class SSEHeartbeatEvent(BaseModel):
     type: Literal[SSEEventType.HEARTBEAT] = SSEEventType.HEARTBEAT
     timestamp: Optional[str] = Field(None, description="Heartbeat timestamp")
 
+class SSEConversationEvent(BaseModel):
+    """SSE event identifying the server-side conversation, sent before any tokens"""
+    type: Literal[SSEEventType.CONVERSATION] = SSEEventType.CONVERSATION
+    conversation_id: str = Field(..., description="ID to send with the next request instead of the full history")
+
 # Union type for all possible SSE events
-SSEEvent = Union[SSETokenEvent, SSEDoneEvent, SSEErrorEvent, SSEHeartbeatEvent]
+SSEEvent = Union[SSETokenEvent, SSEDoneEvent, SSEErrorEvent, SSEHeartbeatEvent, SSEConversationEvent]
 
 class ChatResponse(BaseModel):
     """Standard chat response (non-streaming)"""
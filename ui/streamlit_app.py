@@ -6,13 +6,39 @@ import os
 import json
 import time
 import httpx
-from typing import List, Dict, Any, Optional
-from sseclient import SSEClient
+from contextlib import contextmanager
+from typing import Iterator, List, Dict, Any, Optional
+
+# Prefer orjson for decoding SSE payloads; it parses bytes directly
+try:
+    import orjson
+    json_loads = orjson.loads
+    JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    json_loads = json.loads
+    JSONDecodeError = json.JSONDecodeError
 
 # Configuration
 BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
 
+# Hand streamed text to st.write_stream every this many tokens or seconds, whichever comes first
+RENDER_BATCH_TOKENS = 16
+RENDER_INTERVAL_SECONDS = 0.05
+
+# Read size for the raw SSE byte stream
+SSE_READ_CHUNK_SIZE = 65536
+SSE_DATA_PREFIX = b"data: "
+
+# Most messages the backend accepts in one request (ChatRequest.messages)
+MAX_CHAT_MESSAGES = 50
+
+# Headers for the streaming chat request
+SSE_REQUEST_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "text/event-stream"
+}
+
 # Page configuration
 st.set_page_config(
     page_title="RIVA ChatGPT",
@@ -22,7 +48,7 @@ st.set_page_config(
 )
 
 # Custom CSS for better styling
-st.markdown("""
+CUSTOM_CSS = """
 <style>
     .main-header {
         text-align: center;
@@ -55,32 +81,273 @@ st.markdown("""
         background-color: #1565c0;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
 
-def initialize_session_state():
-    """Initialize session state variables"""
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-    
-    if "temperature" not in st.session_state:
-        st.session_state.temperature = 0.2
-    
-    if "max_tokens" not in st.session_state:
-        st.session_state.max_tokens = 500
+def inject_custom_css():
+    """
+    Inject the custom CSS.
     
-    if "backend_url" not in st.session_state:
-        st.session_state.backend_url = BACKEND_URL
+    Must run on every full rerun: Streamlit drops elements a rerun does not
+    emit, so injecting it once per session would lose the styling. Sidebar
+    fragment reruns do not re-send it.
+    """
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+def initialize_session_state():
+    """Initialize session state variables once per session"""
+    if "_inited" not in st.session_state:
+        st.session_state.update(
+            messages=[],
+            temperature=0.2,
+            max_tokens=500,
+            backend_url=BACKEND_URL,
+            conv_id=None,
+            totals=new_chat_totals(),
+            partial_reply=[],
+            _inited=True
+        )
 
 def display_message(role: str, content: str):
     """Display a chat message with proper styling"""
     with st.chat_message(role):
         st.markdown(content)
 
+def new_chat_totals() -> Dict[str, int]:
+    """Return zeroed running totals for the chat statistics"""
+    return {"user_msgs": 0, "assistant_msgs": 0, "tokens": 0}
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, ~4 characters per token"""
+    return (len(text) + 3) >> 2
+
+def add_message(role: str, content: str):
+    """Append a message to the history and update the running chat totals"""
+    n_tokens = estimate_tokens(content)
+    st.session_state.messages.append({
+        "role": role,
+        "content": content,
+        "n_tokens": n_tokens
+    })
+    
+    totals = st.session_state.totals
+    if role == "user":
+        totals["user_msgs"] += 1
+    elif role == "assistant":
+        totals["assistant_msgs"] += 1
+    totals["tokens"] += n_tokens
+
 def clear_chat():
     """Clear the chat history"""
     st.session_state.messages = []
+    st.session_state.totals = new_chat_totals()
+    st.session_state.conv_id = None
     st.rerun()
 
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    """
+    Return a shared HTTP client so backend connections are kept alive and
+    reused across messages and sessions.
+    
+    HTTP/2 is negotiated when the backend is served over TLS.
+    
+    A sync client is used on purpose. The Streamlit script thread would
+    block in loop.run_until_complete() with an AsyncClient anyway, and an
+    AsyncClient's connection pool is bound to one event loop, so it could
+    not be shared across reruns and sessions like this one.
+    """
+    return httpx.Client(
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300)
+    )
+
+def iter_sse_data(response: httpx.Response) -> Iterator[bytes]:
+    """
+    Yield the raw data payload of each Server-Sent Event in a streaming response.
+    
+    Events are split on blank lines directly in bytes, avoiding per-line
+    str decoding. Comment lines and other fields are skipped. Used instead of
+    sseclient, whose regex-based event detection dominates CPU on fast streams.
+    
+    Args:
+        response: Streaming httpx response from the backend
+        
+    Yields:
+        bytes: Contents of each "data:" field, ready for json_loads
+    """
+    buffer = bytearray()
+    for chunk in response.iter_bytes(SSE_READ_CHUNK_SIZE):
+        buffer += chunk
+        while (end := buffer.find(b"\n\n")) != -1:
+            event = bytes(buffer[:end])
+            del buffer[:end + 2]
+            for field in event.split(b"\n"):
+                # Slice past the prefix rather than strip() to avoid another copy
+                if field.startswith(SSE_DATA_PREFIX):
+                    yield field[len(SSE_DATA_PREFIX):]
+                elif field.startswith(b"data:"):
+                    yield field[5:]
+
+def keep_partial_reply():
+    """
+    Save the reply streamed so far to the history (Stop button callback).
+    
+    The click reruns the script, which aborts the running stream, and this
+    callback runs at the start of that new run. The backend keeps the same
+    partial reply when the request is cancelled, so both histories match.
+    """
+    partial_reply = st.session_state.partial_reply
+    if partial_reply:
+        add_message("assistant", "".join(partial_reply))
+        partial_reply.clear()
+
+class StreamState:
+    """Mutable state shared by the SSE event handlers while a response streams"""
+    __slots__ = ("pending", "received", "last_flush", "error")
+    
+    def __init__(self):
+        self.pending: List[str] = []
+        self.received: List[str] = []
+        self.last_flush = time.monotonic()
+        self.error: Optional[str] = None
+
+def _on_token(state: StreamState, event_data: Dict[str, Any]) -> bool:
+    """Queue a token for the next rendered chunk"""
+    state.pending.append(event_data["text"])
+    state.received.append(event_data["text"])
+    return False
+
+def _on_conversation(state: StreamState, event_data: Dict[str, Any]) -> bool:
+    """Remember the conversation ID; later requests send only new messages"""
+    st.session_state.conv_id = event_data["conversation_id"]
+    return False
+
+def _on_done(state: StreamState, event_data: Dict[str, Any]) -> bool:
+    """Streaming completed"""
+    return True
+
+def _on_error(state: StreamState, event_data: Dict[str, Any]) -> bool:
+    """Record a streaming error and stop"""
+    state.error = event_data.get("message", "Unknown streaming error")
+    return True
+
+# SSE event type -> handler; a handler returns True to stop reading the stream
+SSE_EVENT_HANDLERS = {
+    "token": _on_token,
+    "conversation": _on_conversation,
+    "done": _on_done,
+    "error": _on_error,
+}
+
+def iter_response_text(response: httpx.Response, state: StreamState) -> Iterator[str]:
+    """
+    Yield the assistant's text from the backend SSE stream for st.write_stream.
+    
+    Tokens are coalesced into chunks of RENDER_BATCH_TOKENS tokens or
+    RENDER_INTERVAL_SECONDS, so the response is re-rendered per chunk rather
+    than per token. The last partial chunk is flushed when the stream ends,
+    so no separate final render of the full text is needed.
+    
+    Args:
+        response: Streaming httpx response from the backend
+        state: Stream state, updated with the received text and errors
+        
+    Yields:
+        str: Batches of response text
+    """
+    for data in iter_sse_data(response):
+        # Only JSON objects are events; skip keep-alives without parsing
+        if data[:1] != b"{":
+            if data == b"[DONE]":
+                break
+            continue
+        
+        try:
+            # Parse SSE data and dispatch on the event type
+            event_data = json_loads(data)
+            handler = SSE_EVENT_HANDLERS.get(event_data.get("type"))
+            if handler and handler(state, event_data):
+                break
+                
+        except JSONDecodeError:
+            # Skip malformed JSON
+            continue
+        except KeyError:
+            # Skip events without expected fields
+            continue
+        
+        now = time.monotonic()
+        if len(state.pending) >= RENDER_BATCH_TOKENS or (state.pending and now - state.last_flush > RENDER_INTERVAL_SECONDS):
+            yield "".join(state.pending)
+            state.pending.clear()
+            state.last_flush = now
+    
+    # Flush whatever arrived after the last batch
+    if state.pending:
+        yield "".join(state.pending)
+        state.pending.clear()
+
+def messages_for_request(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """
+    Build the wire form of a message history, as the backend would trim it.
+    
+    Keeps the last MAX_CHAT_MESSAGES messages, starting on a user turn, and
+    only their role and content (the local n_tokens field stays client-side).
+    """
+    start = max(len(messages) - MAX_CHAT_MESSAGES, 0)
+    while start < len(messages) - 1 and messages[start]["role"] != "user":
+        start += 1
+    return [{"role": message["role"], "content": message["content"]} for message in messages[start:]]
+
+def _send_chat_request(client: httpx.Client, backend_url: str, messages: List[Dict[str, str]],
+                       temperature: float, max_tokens: int) -> httpx.Response:
+    """
+    Send the /chat request and return the streaming response, unread.
+    
+    Once the backend has announced a conversation ID, only the newest message
+    is sent. If the backend no longer knows the conversation (HTTP 409), that
+    response is closed and the recent history is sent again to start a new one.
+    """
+    conversation_id = st.session_state.conv_id
+    payload = {
+        "conversation_id": conversation_id,
+        "messages": messages_for_request(messages[-1:] if conversation_id else messages),
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True
+    }
+    
+    request = client.build_request("POST", f"{backend_url}/chat", json=payload, headers=SSE_REQUEST_HEADERS)
+    response = client.send(request, stream=True)
+    if response.status_code == 409 and conversation_id:
+        response.close()
+        st.session_state.conv_id = None
+        return _send_chat_request(client, backend_url, messages, temperature, max_tokens)
+    return response
+
+@contextmanager
+def open_chat_stream(client: httpx.Client, backend_url: str, messages: List[Dict[str, str]],
+                     temperature: float, max_tokens: int) -> Iterator[httpx.Response]:
+    """
+    Open the backend SSE stream for the next assistant reply.
+    
+    Args:
+        client: Shared HTTP client
+        backend_url: Backend API URL
+        messages: Full local message history, ending with the new user message
+        temperature: Sampling temperature
+        max_tokens: Maximum tokens to generate
+        
+    Yields:
+        httpx.Response: Open streaming response, closed when the block exits
+    """
+    response = _send_chat_request(client, backend_url, messages, temperature, max_tokens)
+    try:
+        yield response
+    finally:
+        response.close()
+
 def stream_chat_response(messages: List[Dict[str, str]], temperature: float, max_tokens: int, backend_url: str) -> Optional[str]:
     """
     Stream chat response from the backend API
@@ -95,109 +362,45 @@ def stream_chat_response(messages: List[Dict[str, str]], temperature: float, max
         str: Complete response text, or None if failed
     """
     try:
-        # Prepare the request payload
-        payload = {
-            "messages": messages,
-            "temperature": temperature,
-            "max_tokens": max_tokens,
-            "stream": True
-        }
+        # Create container for streaming text, above the stop button
+        response_container = st.container()
+        state = StreamState()
         
-        # Make streaming request to backend
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "text/event-stream"
-        }
-        
-        # Create placeholder for streaming text
-        response_placeholder = st.empty()
-        accumulated_text = ""
-        
-        # Initialize stop button state
-        if "stop_generation" not in st.session_state:
-            st.session_state.stop_generation = False
-        
-        # Add stop button
+        # Add stop button once, with a stable key, before streaming starts
         stop_button_placeholder = st.empty()
+        stop_button_placeholder.button("⏹️ Stop Generation", key="stop_gen_btn", on_click=keep_partial_reply)
         
-        with httpx.Client(timeout=60.0) as client:
-            with client.stream(
-                "POST",
-                f"{backend_url}/chat",
-                json=payload,
-                headers=headers
-            ) as response:
-                
-                # Check if request was successful
-                if response.status_code != 200:
-                    error_msg = f"Backend error: {response.status_code}"
-                    try:
-                        error_detail = response.json()
-                        error_msg += f" - {error_detail.get('detail', 'Unknown error')}"
-                    except:
-                        pass
-                    st.error(error_msg)
-                    return None
-                
-                # Process SSE stream
-                for line in response.iter_lines():
-                    # Check for stop generation
-                    if st.session_state.stop_generation:
-                        st.session_state.stop_generation = False
-                        st.info("⏹️ Generation stopped by user")
-                        break
-                    
-                    # Add stop button during streaming
-                    if stop_button_placeholder:
-                        with stop_button_placeholder.container():
-                            if st.button("⏹️ Stop Generation", key=f"stop_{time.time()}"):
-                                st.session_state.stop_generation = True
-                                break
-                    
-                    if line.startswith("data: "):
-                        try:
-                            # Parse SSE data
-                            event_data = json.loads(line[6:])  # Remove "data: " prefix
-                            
-                            if event_data.get("type") == "token":
-                                # Add token to accumulated text
-                                token = event_data.get("text", "")
-                                accumulated_text += token
-                                
-                                # Update the display
-                                with response_placeholder.container():
-                                    st.markdown(accumulated_text)
-                                
-                                # Small delay for smooth rendering
-                                time.sleep(0.01)
-                                
-                            elif event_data.get("type") == "done":
-                                # Streaming completed
-                                break
-                                
-                            elif event_data.get("type") == "error":
-                                # Handle streaming error
-                                error_msg = event_data.get("message", "Unknown streaming error")
-                                st.error(f"Streaming error: {error_msg}")
-                                return None
-                                
-                        except json.JSONDecodeError:
-                            # Skip malformed JSON
-                            continue
-                        except KeyError:
-                            # Skip events without expected fields
-                            continue
+        # Expose the text received so far to the Stop button callback
+        st.session_state.partial_reply = state.received
+
+        # Make streaming request to backend
+        client = get_http_client()
+        with open_chat_stream(client, backend_url, messages, temperature, max_tokens) as response:
+            
+            # Check if request was successful
+            if response.status_code != 200:
+                error_msg = f"Backend error: {response.status_code}"
+                try:
+                    error_detail = response.json()
+                    error_msg += f" - {error_detail.get('detail', 'Unknown error')}"
+                except:
+                    pass
+                st.error(error_msg)
+                return None
+            
+            # st.write_stream renders the chunks as they arrive and returns the full text
+            response_text = response_container.write_stream(iter_response_text(response, state))
+            st.session_state.partial_reply = []
+        
+        if state.error:
+            st.error(f"Streaming error: {state.error}")
+            return None
         
         # Clear the stop button
         if stop_button_placeholder:
             stop_button_placeholder.empty()
         
-        # Final update with complete text
-        if accumulated_text:
-            with response_placeholder.container():
-                st.markdown(accumulated_text)
-        
-        return accumulated_text if accumulated_text else None
+        return response_text if response_text else None
         
     except httpx.TimeoutException:
         st.error("⏱️ Request timed out. Please check your backend connection and try again.")
@@ -209,92 +412,107 @@ def stream_chat_response(messages: List[Dict[str, str]], temperature: float, max
         st.error(f"❌ Unexpected error: {str(e)}")
         return None
 
+@st.fragment
+def render_sidebar():
+    """
+    Render the configuration sidebar.
+    
+    Runs as a fragment, so changing a sidebar widget reruns only the sidebar
+    instead of re-rendering the whole chat history.
+    """
+    st.header("⚙️ Configuration")
+    
+    # Model information (read-only)
+    st.subheader("Model")
+    st.info(f"**Current Model:**\n{MODEL_ID}")
+    
+    # Temperature slider
+    st.subheader("Parameters")
+    temperature = st.slider(
+        "Temperature",
+        min_value=0.0,
+        max_value=1.0,
+        value=st.session_state.temperature,
+        step=0.1,
+        help="Controls randomness in responses. Lower values make responses more focused and deterministic."
+    )
+    st.session_state.temperature = temperature
+    
+    # Max tokens input
+    max_tokens = st.number_input(
+        "Max Tokens",
+        min_value=1,
+        max_value=4096,
+        value=st.session_state.max_tokens,
+        step=50,
+        help="Maximum number of tokens to generate in the response."
+    )
+    st.session_state.max_tokens = max_tokens
+    
+    st.divider()
+    
+    # Backend configuration
+    st.subheader("Backend")
+    backend_url = st.text_input(
+        "Backend URL",
+        value=st.session_state.backend_url,
+        help="URL of the RIVA ChatGPT API backend"
+    )
+    st.session_state.backend_url = backend_url
+    
+    st.divider()
+    
+    # Clear chat button
+    if st.button("🗑️ Clear Chat", use_container_width=True):
+        clear_chat()
+    
+    # Chat statistics
+    if st.session_state.messages:
+        st.subheader("📊 Chat Stats")
+        totals = st.session_state.totals
+        st.metric("User Messages", totals["user_msgs"])
+        st.metric("Assistant Messages", totals["assistant_msgs"])
+        st.metric("Tokens (approx.)", totals["tokens"])
+
+def render_chat_history():
+    """Render all messages in the chat history"""
+    for message in st.session_state.messages:
+        display_message(message["role"], message["content"])
+
 def main():
     """Main Streamlit application"""
     
     # Initialize session state
     initialize_session_state()
     
+    # Apply custom styling
+    inject_custom_css()
+    
     # Main title
     st.markdown('<h1 class="main-header">RIVA ChatGPT</h1>', unsafe_allow_html=True)
     
-    # Sidebar configuration
+    # Sidebar configuration, rerun on its own when its widgets change
     with st.sidebar:
-        st.header("⚙️ Configuration")
-        
-        # Model information (read-only)
-        st.subheader("Model")
-        st.info(f"**Current Model:**\n{MODEL_ID}")
-        
-        # Temperature slider
-        st.subheader("Parameters")
-        temperature = st.slider(
-            "Temperature",
-            min_value=0.0,
-            max_value=1.0,
-            value=st.session_state.temperature,
-            step=0.1,
-            help="Controls randomness in responses. Lower values make responses more focused and deterministic."
-        )
-        st.session_state.temperature = temperature
-        
-        # Max tokens input
-        max_tokens = st.number_input(
-            "Max Tokens",
-            min_value=1,
-            max_value=4096,
-            value=st.session_state.max_tokens,
-            step=50,
-            help="Maximum number of tokens to generate in the response."
-        )
-        st.session_state.max_tokens = max_tokens
-        
-        st.divider()
-        
-        # Backend configuration
-        st.subheader("Backend")
-        backend_url = st.text_input(
-            "Backend URL",
-            value=st.session_state.backend_url,
-            help="URL of the RIVA ChatGPT API backend"
-        )
-        st.session_state.backend_url = backend_url
-        
-        st.divider()
-        
-        # Clear chat button
-        if st.button("🗑️ Clear Chat", use_container_width=True):
-            clear_chat()
-        
-        # Chat statistics
-        if st.session_state.messages:
-            st.subheader("📊 Chat Stats")
-            user_messages = len([m for m in st.session_state.messages if m["role"] == "user"])
-            assistant_messages = len([m for m in st.session_state.messages if m["role"] == "assistant"])
-            st.metric("User Messages", user_messages)
-            st.metric("Assistant Messages", assistant_messages)
+        render_sidebar()
     
     # Main chat area
     st.subheader("💬 Chat")
     
     # Display existing messages
-    for message in st.session_state.messages:
-        display_message(message["role"], message["content"])
+    render_chat_history()
     
     # Chat input
     if prompt := st.chat_input("Type your message here..."):
         # Add user message to session state
-        st.session_state.messages.append({
-            "role": "user", 
-            "content": prompt
-        })
+        add_message("user", prompt)
         
         # Display user message
         display_message("user", prompt)
         
         # Stream assistant response
         with st.chat_message("assistant"):
-            with st.spinner("🤔 Thinking..."):
+            # st.status coexists with streamed updates without re-rendering a spinner
+            with st.status("🤔 Generating…", expanded=True) as status:
                 # Stream response from backend
                 response_text = stream_chat_response(
                     messages=st.session_state.messages,
@@ -302,21 +520,19 @@ def main():
                     max_tokens=st.session_state.max_tokens,
                     backend_url=st.session_state.backend_url
                 )
+                if response_text:
+                    status.update(label="Done", state="complete")
+                else:
+                    status.update(label="Failed", state="error")
             
             # Add assistant message to history if we got a response
             if response_text:
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response_text
-                })
+                add_message("assistant", response_text)
             else:
                 # Add error message to history
                 error_msg = "Sorry, I encountered an error processing your request. Please try again."
                 st.error(error_msg)
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": error_msg
-                })
+                add_message("assistant", error_msg)
     
     # Help information
     if not st.session_state.messages: